@@ -1,9 +1,13 @@
 import logging
-import logging.handlers
 import sys
 import os.path
-import contextlib
-import copy
+import io
+import traceback
+import warnings
+try:
+    from sys import intern
+except ImportError: # Python 2: intern is a builtin
+    pass
 
 ###########################################################
 
@@ -20,11 +24,28 @@ __all__ = ['log_to_exception', 'log_exception',
 # The except_hook before we modify it
 default_excepthook = sys.excepthook
 
+# The root logger never changes, so we only look it up once.
+_ROOT = logging.getLogger()
 
-def _log_in_exhook(exception):
-    if hasattr(exception, "log"):
-        for record in exception.log:
-            logging.getLogger(record.name).handle(record)
+
+def _log_in_exhook(log):
+    """
+    Let the handlers of the corresponding loggers handle all log records in log.
+    """
+    # logging.getLogger acquires the module lock and the walk up the
+    # logger hierarchy is the same for all records of one logger.
+    # Only do this once per name.
+    handlers_by_name = {}
+    for record in log:
+        handlers = handlers_by_name.get(record.name)
+        if handlers is None:
+            handlers = _resolve_handlers(logging.getLogger(record.name))
+            handlers_by_name[record.name] = handlers
+        # We call the handlers directly, because the logger's filters
+        # were already applied when the log record was created.
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
 
 def logging_excepthook(type, exception, traceback):
     """
@@ -32,20 +53,39 @@ def logging_excepthook(type, exception, traceback):
     If it finds this attribute, it logs the contained log-records with the
     level ''critical' before calling default_excepthook
     """
-    _log_in_exhook(exception)
+    log = getattr(exception, "log", None)
+    if log:
+        _log_in_exhook(log)
     default_excepthook(type, exception, traceback)
 
 def ipython_handler(self, etype, value, tb, tb_offset=None):
-    _log_in_exhook(value)
+    log = getattr(value, "log", None)
+    if log:
+        _log_in_exhook(log)
     self.showtraceback((etype, value, tb), tb_offset=tb_offset)
     return None
 
-try:
-    ipy = get_ipython()
-except NameError as e:
-    sys.excepthook = logging_excepthook
-else:
-    ipy.set_custom_exc((Exception,), ipython_handler)
+_hook_installed = False
+
+def _install_hook():
+    """
+    Install logging_excepthook (or ipython_handler inside IPython).
+
+    This is called the first time logs are attached to an exception, so
+    importing this module does not modify sys.excepthook.
+    The hook that was active at that time becomes default_excepthook.
+    """
+    global default_excepthook, _hook_installed
+    if _hook_installed:
+        return
+    _hook_installed = True
+    try:
+        ipy = get_ipython()
+    except NameError as e:
+        default_excepthook = sys.excepthook
+        sys.excepthook = logging_excepthook
+    else:
+        ipy.set_custom_exc((Exception,), ipython_handler)
 
 ##############################################################################
 # A costum Logger subclass that does not record functions and filename
@@ -56,12 +96,38 @@ else:
 # as the second string.
 # This variable takes the role of logging._srcfile
 ignored_filenames = [ logging._srcfile, os.path.normcase(logging_excepthook.__code__.co_filename)]
+# A set version of ignored_filenames for fast lookup in findCaller and the
+# copy of ignored_filenames it was built from. See _ignored_files.
+_IGNORED_FILES = frozenset()
+_ignored_files_source = None
+
+
+def _ignored_files():
+    """
+    Return the entries of ignored_filenames as a frozenset.
+
+    The set is cached and rebuilt whenever ignored_filenames has been changed,
+    so filenames can still be added to ignored_filenames after import.
+    Interned strings make the comparisons in the set lookup faster.
+    logging._srcfile may be None.
+    """
+    global _IGNORED_FILES, _ignored_files_source
+    if ignored_filenames != _ignored_files_source:
+        source = list(ignored_filenames)
+        _IGNORED_FILES = frozenset(intern(filename) if isinstance(filename, str)
+                                   else filename
+                                   for filename in source if filename is not None)
+        _ignored_files_source = source
+    return _IGNORED_FILES
+
+# Maps a code object's co_filename to its normcased version
+_normcase_cache = {}
 
 
 class ExlogLogger(logging.Logger):
     def __init__(self, name, level=logging.NOTSET):
         super(ExlogLogger, self).__init__(name, level)
-        self.ignored_functions = []
+        self.ignored_functions = set()
 
     def findCaller(self, stack_info=False, stacklevel=1):
         """
@@ -71,19 +137,45 @@ class ExlogLogger(logging.Logger):
         the function with the logging call, this also ignores logging_exceptions.
 
         This is implemented by replacing
+
+        As in Python 3.11, stacklevel counts only frames that are not ignored.
+        If there are fewer such frames than stacklevel, the outermost one is used.
         """
-        f = logging.currentframe()
-        #On some versions of IronPython, currentframe() returns None if
-        #IronPython isn't run with -X:Frames.
-        if f is not None:
-            f = f.f_back
-        rv = "(unknown file)", 0, "(unknown function)", None
-        while hasattr(f, "f_code"):
+        try:
+            # Start directly at our caller (usually logging.Logger._log)
+            f = sys._getframe(1)
+        except (AttributeError, ValueError):
+            f = logging.currentframe()
+            #On some versions of IronPython, currentframe() returns None if
+            #IronPython isn't run with -X:Frames.
+            if f is not None:
+                f = f.f_back
+        # Local names are faster than global names and attributes in the loop.
+        normcase_cache = _normcase_cache
+        ignored_files = _ignored_files()
+        ignored_functions = self.ignored_functions
+        # The last frame that was not ignored
+        caller = None
+        while f is not None:
             co = f.f_code
-            filename = os.path.normcase(co.co_filename)
-            if filename in ignored_filenames or co.co_name in self.ignored_functions:
+            co_filename = co.co_filename
+            filename = normcase_cache.get(co_filename)
+            if filename is None:
+                filename = intern(os.path.normcase(co_filename))
+                normcase_cache[co_filename] = filename
+            if filename in ignored_files or co.co_name in ignored_functions:
                 f = f.f_back
                 continue
+            caller = f
+            if stacklevel <= 1:
+                break
+            stacklevel -= 1
+            f = f.f_back
+        f = caller
+        if f is None:
+            rv = "(unknown file)", 0, "(unknown function)", None
+        else:
+            co = f.f_code
             sinfo = None
             if stack_info:
                 sio = io.StringIO()
@@ -94,7 +186,6 @@ class ExlogLogger(logging.Logger):
                     sinfo = sinfo[:-1]
                 sio.close()
             rv = (co.co_filename, f.f_lineno, co.co_name, sinfo)
-            break
         if sys.version_info.major<3:
             return rv[:3]
         return rv
@@ -102,8 +193,7 @@ class ExlogLogger(logging.Logger):
 
 logging.setLoggerClass(ExlogLogger)
 
-@contextlib.contextmanager
-def log_at_caller(logger):
+class log_at_caller(object):
     """
     A context manager for using the parent function as the
     function name attached to the log record
@@ -117,23 +207,39 @@ def log_at_caller(logger):
         If logger is not an instance of ExlogLogger (in particular if it is the root logger),
         this context manager will do nothing
 
+    .. warning::
+
+        The logger's ignored_functions are shared by all threads. While one
+        thread is inside this context manager, the caller's function name is
+        ignored for records logged by all threads.
+
     New in Version 0.1.6
     """
-    # store the original ignored_functions
-    try:
-        orig_ignored_f = logger.ignored_functions
-    except AttributeError: #The logger is not a ExlogLogger. Do nothing
-        orig_ignored_f = None
-    else:
-        # Make a copy of ignored_functions and add the caller of this contect manager
-        logger.ignored_functions = copy.copy(logger.ignored_functions)
-        f = logging.currentframe()
-        logger.ignored_functions.append(f.f_code.co_name)
-    try:
-        yield
-    finally:
-        if orig_ignored_f is not None:
-            logger.ignored_functions = orig_ignored_f
+    __slots__ = ("logger", "_ignored_functions", "_name")
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._ignored_functions = None
+        self._name = None
+
+    def __enter__(self):
+        try:
+            ignored_functions = self.logger.ignored_functions
+        except AttributeError: #The logger is not a ExlogLogger. Do nothing
+            return
+        # Add the caller of this context manager. Frame 0 is __enter__.
+        name = intern(sys._getframe(1).f_code.co_name)
+        # If the name is already ignored (e.g. by an outer log_at_caller),
+        # do not remove it on exit.
+        if name not in ignored_functions:
+            ignored_functions.add(name)
+            self._ignored_functions = ignored_functions
+            self._name = name
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._ignored_functions is not None:
+            self._ignored_functions.discard(self._name)
+            self._ignored_functions = None
 
 
 ###############################################################################
@@ -142,34 +248,73 @@ def log_at_caller(logger):
 ###############################################################################
 
 
-@contextlib.contextmanager
-def log_to_exception(logger, exception):
-    # __enter__:
-    # store the original logger configuration
-    propagate = logger.propagate
-    original_handlers = logger.handlers
-    # Assign a new handler
-    logger.handlers = [logging.handlers.BufferingHandler(1000)]
-    logger.propagate = False
-    try:
-        yield
-    finally:
-        # __exit__:
+class _ListHandler(logging.Handler):
+    """
+    A handler that only collects log records in the list self.buffer.
+
+    Unlike logging.handlers.BufferingHandler, it has no capacity and never flushes.
+    """
+    def __init__(self):
+        super(_ListHandler, self).__init__()
+        self.buffer = []
+
+    def emit(self, record):
+        self.buffer.append(record)
+
+    def handle(self, record):
+        # This handler is private and has no filters, and list.append is
+        # atomic. So we do not need Handler.handle's filtering and locking.
+        self.buffer.append(record)
+        return True
+
+
+class log_to_exception(object):
+    """
+    A context manager that attaches all records logged by logger inside the
+    with statement to exception (as the list exception.log).
+
+    While inside the with statement, the logger's handlers are replaced by a
+    handler that collects the records and propagation is switched off.
+    """
+    __slots__ = ("logger", "exception", "_propagate", "_handlers", "_handler")
+
+    def __init__(self, logger, exception):
+        self.logger = logger
+        self.exception = exception
+
+    def __enter__(self):
+        _install_hook()
+        logger = self.logger
+        # store the original logger configuration
+        self._propagate = logger.propagate
+        self._handlers = logger.handlers
+        # Assign a new handler
+        self._handler = _ListHandler()
+        logger.handlers = [self._handler]
+        logger.propagate = False
+
+    def __exit__(self, exc_type, exc_value, tb):
+        exception = self.exception
         # Attach the log records to the exception
-        if hasattr(exception, "log"):
+        buffer = self._handler.buffer
+        prior_log = getattr(exception, "log", None)
+        if prior_log is None:
+            # The handler is discarded, so we can use its list without copying it.
+            exception.log = buffer
+        elif isinstance(prior_log, list):
+            prior_log += buffer
+        else:
             try:
-                exception.log.extend(logger.handlers[0].buffer)
+                prior_log.extend(buffer)
             except AttributeError:
                 # No attribute extend. Issue a warning and discard buffered
-                log = logging.getLogger(__name__)
                 warnings.warn("Cannot attach log to exception {}. "
                               "Potential name clash with attribute "
                               "'log'".format(type(exception).__name__))
-        else:
-            exception.log = logger.handlers[0].buffer
         # Restore original logger configutration
-        logger.propagate = propagate
-        logger.handlers = original_handlers
+        self.logger.propagate = self._propagate
+        self.logger.handlers = self._handlers
+        self._handler = None
 
 
 def log_exception(exception, level=None, logger=None, with_stacktrace=True):
@@ -179,25 +324,75 @@ def log_exception(exception, level=None, logger=None, with_stacktrace=True):
     If a logger is given, its name is not used, however, its handler
     and its level are respected.
 
+    If the exception has a traceback, the message about the exception itself
+    is logged with the filename, line number and function where the exception
+    was raised.
+
     :param with_stacktrace: Whether or not to show the stack_trace. New in version 0.1.5
     """
     if hasattr(exception, "log"):
+        if level is not None:
+            levelname = logging.getLevelName(level)
+        # For every logger name: The logger, its bound method isEnabledFor
+        # and the handlers logger.callHandlers would call.
+        loggers = {}
+        record_logger = logger
         for record in exception.log:
-            _log_at_level(record, level, logger)
+            cached = loggers.get(record.name)
+            if cached is None:
+                if logger is None:
+                    record_logger = logging.getLogger(record.name)
+                else:
+                    record_logger = logger
+                cached = (record_logger, record_logger.isEnabledFor,
+                          _resolve_handlers(record_logger))
+                loggers[record.name] = cached
+            record_logger, is_enabled_for, handlers = cached
+            if level is not None:
+                record.levelno = level
+                record.levelname = levelname
+            if is_enabled_for(record.levelno):
+                # We call the handlers directly instead of logger.handle, because
+                # we already applied the filters when the log record was created.
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
         if exception.log and logger is None:
-            logger = logging.getLogger(exception.log[-1].name)
+            logger = record_logger
     if level is None:
         level = logging.CRITICAL
-
     if logger is None:
-        logger = logging.getLogger()
-    if level is None:
-        level = logging.CRITICAL
-    msg = "Exception of type '%s' occurred:"
-    if not with_stacktrace:
-        msg += " "+str(exception)
-    logger.log(level, msg,
-               type(exception).__name__, exc_info=with_stacktrace)
+        logger = _ROOT
+    if not logger.isEnabledFor(level):
+        return
+    # The exception is converted to a string only when the record is formatted.
+    # Passing it as an argument also keeps '%' in the exception message intact.
+    if with_stacktrace:
+        msg = "Exception of type '%s' occurred:"
+        args = (type(exception).__name__,)
+    else:
+        msg = "Exception of type '%s' occurred: %s"
+        args = (type(exception).__name__, exception)
+    raise_site = _find_raise_site(exception)
+    if raise_site is None:
+        logger.log(level, msg, *args, exc_info=with_stacktrace)
+        return
+    fn, lno, func, tb = raise_site
+    if with_stacktrace:
+        # Use the exception's own traceback, not the one of the exception
+        # that is currently being handled (if any).
+        exc_info = (type(exception), exception, tb)
+    else:
+        exc_info = None
+    if not isinstance(logger, logging.Logger):
+        # E.g. a logging.LoggerAdapter, which has no makeRecord and handle.
+        logger.log(level, msg, *args, exc_info=exc_info)
+    else:
+        # The traceback already knows where the exception was raised,
+        # so we do not need findCaller to walk the stack.
+        record = logger.makeRecord(logger.name, level, fn, lno, msg, args,
+                                   exc_info, func)
+        logger.handle(record)
 
 
 log = log_exception
@@ -211,6 +406,10 @@ class _Default:
     pass
 _DEFAULT = _Default()
 
+# Logger names used on the commandline for the root logger.
+# logging.getLogger("") returns the root logger as well.
+_ROOT_ALIASES = frozenset(("__root__", ""))
+
 
 def update_parser(parser, use_shortcuts=True):
     """
@@ -240,46 +439,86 @@ def config_from_args(args):
     Handle the --quiet, --verbose and --debug options.
     """
     if hasattr(args, "verbose") and args.verbose:
-        logging.getLogger().setLevel(logging.INFO)
+        _apply_level(_DEFAULT, logging.INFO)
     if args.debug is not None:
-        if args.debug is _DEFAULT:
-            logging.getLogger().setLevel(logging.DEBUG)
-        else:
-            for logger_name in args.debug.split(","):
-                if logger_name == "__root__":
-                    logging.getLogger().setLevel(logging.DEBUG)
-                logging.getLogger(logger_name).setLevel(logging.DEBUG)
+        _apply_level(args.debug, logging.DEBUG)
     if args.quiet is not None:
-        if args.quiet is _DEFAULT:
-            logging.getLogger().setLevel(logging.CRITICAL)
-        else:
-            for logger_name in args.quiet.split(","):
-                if logger_name == "__root__":
-                    logging.getLogger().setLevel(logging.CRITICAL)
-                logging.getLogger(logger_name).setLevel(logging.CRITICAL)
+        _apply_level(args.quiet, logging.CRITICAL)
 
 ###############################################################################
 # Private utility functions
 ###############################################################################
 
 
-def _log_at_level(record, level=None, logger=None):
+def _apply_level(logger_names, level):
     """
-    Log a log-record at the given level using the given logger.
+    Set the level of all loggers in logger_names.
 
-    If logger is None, uses the root logger.
-    If level is None, use the record's level.
+    :param logger_names: A comma-seperated list of logger names or _DEFAULT
+                         for the root logger.
     """
-    if logger is None:
-        logger = logging.getLogger(record.name)
-    if level is not None:
-        record.levelno = level
-        record.levelname = logging.getLevelName(level)
+    if logger_names is _DEFAULT:
+        logger_names = ("__root__",)
+    elif "," in logger_names:
+        logger_names = set(logger_names.split(","))
+    else:
+        logger_names = (logger_names,)
+    for logger_name in logger_names:
+        if logger_name in _ROOT_ALIASES:
+            logger = _ROOT
+        else:
+            logger = logging.getLogger(logger_name)
+        # setLevel clears the level cache of all loggers.
+        if logger.level != level:
+            logger.setLevel(level)
 
-    if record.levelno >= logger.getEffectiveLevel():
-        # We use callHandlers instead of handle, because we already applied
-        # the filters when the log record was created.
-        logger.callHandlers(record)
+
+def _find_raise_site(exception):
+    """
+    Return the tuple (filename, line number, function name, traceback),
+    where the first three items describe the place where the exception
+    was raised and traceback is the exception's full traceback.
+
+    The traceback is taken from exception.__traceback__ (Python 3) or
+    from sys.exc_info(), if exception is the exception currently being handled.
+    If no traceback is available, return None.
+    """
+    tb = getattr(exception, "__traceback__", None)
+    if tb is None:
+        exc_info = sys.exc_info()
+        if exc_info[1] is exception:
+            tb = exc_info[2]
+    if tb is None:
+        return None
+    last_tb = tb
+    while last_tb.tb_next is not None:
+        last_tb = last_tb.tb_next
+    co = last_tb.tb_frame.f_code
+    return co.co_filename, last_tb.tb_lineno, co.co_name, tb
+
+
+def _resolve_handlers(logger):
+    """
+    Return a list of all handlers logger.callHandlers would call.
+
+    Like logging.Logger.callHandlers, this walks up the logger hierarchy
+    until a logger with propagate == False is found. If no handler is found,
+    logging.lastResort is used (Python 3 only).
+    If the logger is disabled, an empty list is returned.
+    """
+    handlers = []
+    if logger.disabled:
+        return handlers
+    while logger is not None:
+        handlers.extend(logger.handlers)
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    if not handlers:
+        last_resort = getattr(logging, "lastResort", None)
+        if last_resort is not None:
+            handlers.append(last_resort)
+    return handlers
 
 
 ###############################################################################
@@ -313,27 +552,55 @@ COLORS_DARK = {
 
 
 class ColoredFormatter(logging.Formatter):
-    def __init__(self, colors, msg=None):
+    def __init__(self, colors, msg=None, enabled=True):
+        """
+        :param enabled: If False, the messages are not colored.
+                        Use this if the output is not a terminal.
+        """
         logging.Formatter.__init__(self, msg)
         self.colors = colors
+        self.enabled = enabled
+        # The escape sequence for every levelname
+        if enabled:
+            self._prefix = dict((levelname, COLOR_SEQ % (30 + color))
+                                for levelname, color in colors.items())
+        else:
+            self._prefix = {}
 
     def format(self, record):
-        levelname = record.levelname
-        return (COLOR_SEQ % (30 + self.colors[levelname]) +
-                logging.Formatter.format(self, record) + RESET_SEQ)
+        prefix = self._prefix.get(record.levelname)
+        formatted = logging.Formatter.format(self, record)
+        if prefix is None:
+            # No color for this level or colors are disabled
+            return formatted
+        return prefix + formatted + RESET_SEQ
+
+
+def _isatty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError): # No isatty or stream is closed
+        return False
 
 
 def use_colored_output(dark_bg=False):
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
+    """
+    Use a ColoredFormatter for the first handler of the root logger.
+
+    If the root logger has no handler, a StreamHandler is added.
+    The output is only colored if the handler's stream is a terminal.
+    """
     if dark_bg:
         colors = COLORS_DARK
     else:
         colors = COLORS_LIGHT
-    cf = ColoredFormatter(
-            colors, "%(levelname)s:%(name)s.%(funcName)s[%(lineno)d]: %(message)s")
     try:
-        logging.getLogger().handlers[0].setFormatter(ch)
+        handler = _ROOT.handlers[0]
     except IndexError:
-        ch.setFormatter(cf)
-        logging.getLogger().addHandler(ch)
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.DEBUG)
+        _ROOT.addHandler(handler)
+    cf = ColoredFormatter(
+            colors, "%(levelname)s:%(name)s.%(funcName)s[%(lineno)d]: %(message)s",
+            enabled=_isatty(getattr(handler, "stream", None)))
+    handler.setFormatter(cf)